@@ -1,32 +1,45 @@
 #!/usr/bin/env python3
 
 import math
-import shutil
-import subprocess
+import os
+import sys
+import time
+from functools import lru_cache
 
 MIN_TERMINAL_WIDTH: int = 80
 ROOT_RESERVED: float = 0.05     # see: https://askubuntu.com/questions/249387/df-h-used-space-avail-free-space-is-less-than-the-total-size-of-home
                                 # see: https://unix.stackexchange.com/questions/7950/reserved-space-for-root-on-a-filesystem-why
 NAME_MAX_LEN: int = 10
 PATH_MAX_LEN: int = 25
+PSEUDO_FS_TYPES: "set[bytes]" = {b"proc", b"sysfs", b"tmpfs", b"devtmpfs", b"devpts", b"overlay"}
+BAR_FILLED: str = "▇" * 512     # prebuilt once and sliced per partition, wider bars fall back to "▇" * n
+BAR_EMPTY: str = "▁" * 512
+CACHE_TTL: float = 5            # seconds, override with CHECK_DISK_CACHE_TTL (0 disables the cache)
 
 
 class Partition:
-    # size and usedSize is in bytes
+    __slots__ = ("name", "path", "size", "usedSize")
+
+    # size and usedSize is in kbytes, usedSize already includes the space reserved for root
     def __init__(self, name: str = "", path: str = "", size: int = 0, usedSize: int = 0) -> None:
         self.name: str = name
         self.path: str = path
         self.size: int = size
-        self.usedSize: int = usedSize + int(ROOT_RESERVED*self.size)
+        self.usedSize: int = usedSize
+
+    # size is in kbytes
+    @classmethod
+    def from_used_size(cls, name: str = "", path: str = "", size: int = 0, usedSize: int = 0) -> "Partition":
+        return cls(name, path, size, usedSize + int(ROOT_RESERVED*size))
 
     # size is in kbytes
     @classmethod
-    def from_percentage(cls, name: str = "", path: str = "", size: int = 0, usedPercentage: float = 0) -> None:
+    def from_percentage(cls, name: str = "", path: str = "", size: int = 0, usedPercentage: float = 0) -> "Partition":
         usedSize: int = int(usedPercentage * size / 100)
-        cls(name, path, size, usedSize)
+        return cls.from_used_size(name, path, size, usedSize)
 
     # progress is normalized
-    def print(self, terminalWidth: int):
+    def format(self, terminalWidth: int) -> str:
         try:
             progress = self.usedSize / self.size
         except:
@@ -39,7 +52,7 @@ class Partition:
 
         size = f"{formatBytes(self.size):>6}"
 
-        usedPercentage = f"{round(progress*100, 1):>4}"
+        usedPercentage = f"{progress*100:>4.1f}"
 
         # 0 <= progress <= 1
         progress = min(1, max(0, progress))
@@ -51,12 +64,17 @@ class Partition:
 
         if (width - whole_width - 1) < 0:
             part_char = ""
-        bar = "▇" * whole_width + part_char + "▁" * (width - whole_width - 1) if terminalWidth >= MIN_TERMINAL_WIDTH else '-'
+        if terminalWidth < MIN_TERMINAL_WIDTH:
+            bar = '-'
+        elif width <= len(BAR_FILLED):
+            # width goes negative when name and path eat the whole line, slicing must not wrap around then
+            bar = BAR_FILLED[:max(0, whole_width)] + part_char + BAR_EMPTY[:max(0, width - whole_width - 1)]
+        else:
+            bar = "▇" * whole_width + part_char + "▁" * (width - whole_width - 1)
 
         name: str = self.name if len(self.name) <= NAME_MAX_LEN else self.name[:NAME_MAX_LEN-1] + "…"
         path: str = self.path if len(self.path) <= PATH_MAX_LEN else self.path[:PATH_MAX_LEN-1] + "…"
-        line = f"{name:<{NAME_MAX_LEN}}  {path:<{PATH_MAX_LEN}}  {usedPercentage}% of {size} {bar} {free}"
-        print(line)
+        return f"{name:<{NAME_MAX_LEN}}  {path:<{PATH_MAX_LEN}}  {usedPercentage}% of {size} {bar} {free}"
 
 
 def toBytes(size: str):
@@ -67,51 +85,156 @@ def toBytes(size: str):
     return int(size[:-1]) * ordering[size[-1]]
 
 
-def formatBytes(kBytes: float) -> str:
-    orderNames = {0: "k", 3: "M", 6: "G", 9: "T"}
+ORDER_NAMES: "tuple[str, ...]" = ("k", "M", "G", "T")
+
+
+@lru_cache(maxsize=512)
+def formatBytes(kBytes: int) -> str:
+    # negative sizes (free space eaten by the root reserve) are never scaled
+    if kBytes < 0:
+        return f"{int(kBytes)}{ORDER_NAMES[0]}"
 
-    order = 0
-    while (kBytes > 1023):
-        kBytes /= 1024
-        order += 3
+    # each order is 2^10 times the previous one, so the order is read off the bit length
+    order = min(len(ORDER_NAMES) - 1, max(0, (int(kBytes).bit_length() - 1) // 10))
+    kBytes /= 1 << (order * 10)
 
-    if (order < 6):
-        kBytes = int(kBytes)
+    if (order < 2):
+        return f"{int(kBytes)}{ORDER_NAMES[order]}"
     else:
-        kBytes = round(kBytes, 1)
+        return f"{kBytes:.1f}{ORDER_NAMES[order]}"
 
-    return str(kBytes) + orderNames[order]
+
+def getTerminalWidth(fallback: int = 80) -> int:
+    # same lookup as shutil.get_terminal_size, without paying for the shutil import on every run
+    try:
+        columns = int(os.environ["COLUMNS"])
+    except (KeyError, ValueError):
+        columns = 0
+
+    if columns <= 0:
+        try:
+            columns = os.get_terminal_size(sys.__stdout__.fileno()).columns
+        except (AttributeError, ValueError, OSError):
+            columns = 0
+
+    return columns if columns > 0 else fallback
 
 
 def test():
-    part = Partition("/dev/sda6", "/home", 123987, 123000)
-    terminalWidth, _ = shutil.get_terminal_size((80, 20))
-    part.print(terminalWidth)
+    part = Partition.from_used_size("/dev/sda6", "/home", 123987, 123000)
+    terminalWidth = getTerminalWidth()
+    print(part.format(terminalWidth))
 
+    # name and path too long for an 80 column terminal leave no room for a bar
+    global NAME_MAX_LEN
+    global PATH_MAX_LEN
+    NAME_MAX_LEN, PATH_MAX_LEN = 26, 26
+    part = Partition.from_used_size("/dev/mapper/luks-0123456789", "/run/media/user/some-long-label", 123987, 60000)
+    line = part.format(MIN_TERMINAL_WIDTH)
+    assert len(line) <= 88 and "▇" not in line and "▁" not in line, line
+    print(line)
+
+
+def unescapeMountField(field: str) -> str:
+    # /proc/mounts encodes space, tab, newline and backslash as octal escapes (e.g. \040)
+    if "\\" not in field:
+        return field
+
+    import re
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m[1], 8)), field)
+
+
+def getPartitions() -> "list[Partition]":
+    # stacked mounts on the same path: the last entry is the visible one, so later entries win
+    mountedDevices = {}
+    # read raw bytes and only decode the device of mounts that are kept
+    with open("/proc/self/mounts", "rb") as mounts:
+        for line in mounts:
+            # only device, mountpoint and fs type are needed, leave the options unsplit
+            line = line.split(None, 3)
+            mountedDevices[line[1]] = (line[0], line[2])
+
+    # bind mounts of the same filesystem are listed once, under the shortest mountpoint like df
+    partsByDevice = {}
+    for path, (name, fsType) in mountedDevices.items():
+        # filter on the visible mount only, a pseudo fs stacked on a real one hides it
+        if fsType in PSEUDO_FS_TYPES or fsType.startswith(b"cgroup"):
+            continue
+
+        name, path = unescapeMountField(os.fsdecode(name)), unescapeMountField(os.fsdecode(path))
+        try:
+            device = os.stat(path).st_dev
+            stat = os.statvfs(path)
+        except OSError:
+            continue
+
+        # pseudo filesystems not listed above report zero blocks, df hides them too
+        if stat.f_blocks == 0:
+            continue
+
+        seen = partsByDevice.get(device)
+        if seen is not None and len(seen.path) <= len(path):
+            continue
+
+        blockSize = stat.f_frsize
+        size = stat.f_blocks * blockSize
+        used = size - stat.f_bfree * blockSize
+
+        # size and used size is in kbytes, like df
+        partsByDevice[device] = Partition.from_used_size(name, path, size // 1024, used // 1024)
+
+    parts = list(partsByDevice.values())
+    parts.sort(key=lambda part: part.name)
+    return parts
+
+
+def getCachePath() -> str:
+    cacheHome = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cacheHome, "check_disk_usage", "cache")
+
+
+def getCacheTtl() -> float:
+    try:
+        return float(os.environ.get("CHECK_DISK_CACHE_TTL", CACHE_TTL))
+    except ValueError:
+        return CACHE_TTL
+
+
+# the table layout depends on the terminal width, so the cache holds it on its first line
+# and a cache rendered for another width is a miss
+def readCache(cachePath: str, ttl: float, terminalWidth: int) -> "str | None":
+    try:
+        if time.time() - os.stat(cachePath).st_mtime >= ttl:
+            return None
+        with open(cachePath) as cache:
+            width, _, output = cache.read().partition("\n")
+    except OSError:
+        return None
+
+    return output if width == str(terminalWidth) else None
+
+
+def writeCache(cachePath: str, terminalWidth: int, output: str):
+    # write to a temporary file and rename it so concurrent runs never see a partial cache
+    tempPath = f"{cachePath}.{os.getpid()}"
+    try:
+        os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+        with open(tempPath, "w") as cache:
+            cache.write(f"{terminalWidth}\n{output}")
+        os.replace(tempPath, cachePath)
+    except OSError:
+        try:
+            os.unlink(tempPath)
+        except OSError:
+            pass
 
-def main():
+
+def renderPartitions(terminalWidth: int) -> str:
     # get list of filesystems
-    command = "df 2> /dev/null | tail -n+2 | sort -k1"
-    result = subprocess\
-        .run(command, shell=True, stdout=subprocess.PIPE)\
-        .stdout\
-        .decode("utf-8")\
-        .rstrip()
-    lines = result.split('\n')
-
-    terminalWidth, _ = shutil.get_terminal_size((80, 20))
-
-    # 0 5 1 4
-    parts = []
-    longestNameLength = 0
-    longestPathLength = 0
-    for line in lines:
-        line = line.split()
-        #                name     path     size          used size
-        part = Partition(line[0], line[5], int(line[1]), int(line[2]))
-        parts.append(part)
-        longestNameLength = len(part.name) if len(part.name) > longestNameLength else longestNameLength
-        longestPathLength = len(part.path) if len(part.path) > longestPathLength else longestPathLength
+    parts = getPartitions()
+
+    longestNameLength = max((len(part.name) for part in parts), default=0)
+    longestPathLength = max((len(part.path) for part in parts), default=0)
 
     global NAME_MAX_LEN
     global PATH_MAX_LEN
@@ -124,8 +247,28 @@ def main():
         PATH_MAX_LEN = longestPathLength
 
     parts = sorted(parts, key=lambda part: (1 - ROOT_RESERVED) - part.usedSize/part.size)
-    for part in parts:
-        part.print(terminalWidth)
+
+    lines = [part.format(terminalWidth) for part in parts]
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def main():
+    terminalWidth = getTerminalWidth()
+
+    # the usage only changes slowly, so frequent callers (e.g. status bars) reuse the last result
+    ttl = getCacheTtl()
+    if ttl <= 0:
+        output = renderPartitions(terminalWidth)
+    else:
+        cachePath = getCachePath()
+        output = readCache(cachePath, ttl, terminalWidth)
+        if output is None:
+            output = renderPartitions(terminalWidth)
+            writeCache(cachePath, terminalWidth, output)
+
+    # one write for the whole table instead of one per partition
+    sys.stdout.write(output)
+    sys.stdout.flush()
 
 
 if __name__ == "__main__":